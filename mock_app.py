@@ -1,27 +1,145 @@
+import atexit
+import bisect
+import itertools
 import logging
+import os
+import queue
 import random
+import signal
+import sys
+import threading
 import time
-from logging_loki import LokiHandler
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+import requests
+from requests.adapters import HTTPAdapter
 
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.trace.sampling import Decision, ParentBased, Sampler, SamplingResult, TraceIdRatioBased
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.sdk.resources import Resource
 
+# --- Shared HTTP Session ---
+# One keep-alive connection pool shared by all Loki handlers, so sockets stay
+# warm between pushes.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
 # --- Logging (Loki) Setup ---
+LOKI_PUSH_URL = "http://127.0.0.1:3100/loki/api/v1/push"
+
+class BatchLokiHandler(logging.Handler):
+    """Buffer log lines and push them to Loki in batches.
+
+    Records are flushed once per `flush_interval` seconds, or as soon as the
+    buffer holds `max_buffer` entries, as a single push grouped by label set.
+    One handler serves every service: the `service` label comes from the
+    record's logger name.
+    """
+
+    def __init__(self, url, tags, max_buffer=200, flush_interval=1.0, session=None):
+        super().__init__()
+        self.url = url
+        self.session = session or requests.Session()
+        self.tags = tags
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def build_labels(self, record):
+        labels = dict(self.tags)
+        labels["service"] = record.name
+        labels["severity"] = record.levelname.lower()
+        labels["logger"] = record.name
+        for key, value in getattr(record, "tags", {}).items():
+            labels[key] = str(value)
+        return labels
+
+    def emit(self, record):
+        try:
+            entry = (
+                str(int(record.created * 1e9)),
+                self.build_labels(record),
+                self.format(record),
+            )
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lock:
+            self.buffer.append(entry)
+            full = len(self.buffer) >= self.max_buffer
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            entries, self.buffer = self.buffer, []
+        if not entries:
+            return
+
+        # Group entries into one stream per unique label set
+        streams = {}
+        for ts, labels, line in entries:
+            key = tuple(sorted(labels.items()))
+            stream = streams.get(key)
+            if stream is None:
+                stream = streams[key] = {"stream": labels, "values": []}
+            stream["values"].append([ts, line])
+
+        try:
+            # Set Content-Type per request so headers on a shared session can't override it
+            response = self.session.post(
+                self.url,
+                json={"streams": list(streams.values())},
+                headers={"Content-Type": "application/json"},
+                timeout=5,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            sys.stderr.write(f"Failed to push {len(entries)} log lines to Loki: {e}\n")
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+        super().close()
+
+# A single batching handler shared by every service, so all logs go out in
+# one push per flush interval
+loki_handler = BatchLokiHandler(
+    url=LOKI_PUSH_URL,
+    tags={"application": "my-app"},
+    session=SESSION,
+)
+# Prefix each message with the service (logger) name
+loki_handler.setFormatter(logging.Formatter('[%(name)s] - %(message)s'))
+
+# Listeners that ship queued records to Loki from a background thread
+log_listeners = []
+
 def create_loki_logger(service_name):
-    handler = LokiHandler(
-        url="http://127.0.0.1:3100/loki/api/v1/push",
-        tags={"application": "my-app", "service": service_name},
-        version="1",
-    )
-    # Create a custom formatter to add the service name to the message
-    formatter = logging.Formatter(f'[{service_name}] - %(message)s')
-    handler.setFormatter(formatter)
+    # The logger only enqueues records; the HTTP push to Loki happens in the
+    # listener thread so service functions never block on the network.
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, loki_handler)
+    listener.start()
+    log_listeners.append(listener)
+    atexit.register(listener.stop)
 
     logger = logging.getLogger(service_name)
-    logger.addHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
     logger.setLevel(logging.INFO)
     return logger
 
@@ -32,21 +150,74 @@ loggers = {
     "my-app": create_loki_logger("my-app"),
 }
 
-# --- OpenTelemetry (Tempo) Setup - Three Separate Tracer Providers ---
+# --- OpenTelemetry (Tempo) Setup - One Span Processor Shared by Three Tracer Providers ---
+# Each service keeps its own provider and Resource so Tempo sees three real
+# services, but all of them feed the same BatchSpanProcessor: one exporter
+# thread and one connection to Tempo.
+
+def env_number(name, default, cast=int):
+    """Read a numeric setting from the environment, falling back to `default` if it is malformed."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        logging.getLogger(__name__).warning("Invalid value %r for %s; using default %r", value, name, default)
+        return default
+
+# Root span attribute naming where the request will fail ("success" if it won't)
+OUTCOME_ATTRIBUTE = "app.request.outcome"
+
+class ErrorSampler(Sampler):
+    """Always sample requests that are going to fail; defer the rest to `delegate`."""
+
+    def __init__(self, delegate):
+        self._delegate = delegate
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        if attributes and attributes.get(OUTCOME_ATTRIBUTE, "success") != "success":
+            return SamplingResult(Decision.RECORD_AND_SAMPLE, attributes, trace_state)
+        return self._delegate.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+
+    def get_description(self):
+        return f"ErrorSampler{{{self._delegate.get_description()}}}"
+
+# Head-based sampling: keep every failing request plus 10% of the rest (override
+# with OTEL_TRACES_SAMPLER_ARG). Child spans follow their parent's decision so
+# sampled traces stay complete.
+# Because errors are always kept, exported traces over-represent them: with
+# ~15% of requests failing, roughly two thirds of exported root spans are
+# errors. Error ratios that Tempo's span-metrics / service-graphs generators
+# derive are inflated by the same factor; count errors from Loki instead. Logs
+# of unsampled requests carry trace_id "unknown" (see get_trace_id).
+sampler = ParentBased(ErrorSampler(TraceIdRatioBased(env_number("OTEL_TRACES_SAMPLER_ARG", 0.1, float))))
+
+# OTLP over gRPC keeps one HTTP/2 connection open and multiplexes batches on it
+otlp_exporter = OTLPSpanExporter(
+    endpoint="127.0.0.1:4317",
+    insecure=True,
+)
+
+# Batch settings sized for a low span rate: small batches flushed every second
+# instead of the SDK defaults (512 spans / 5s). Override with OTEL_BSP_* env vars.
+span_processor = BatchSpanProcessor(
+    otlp_exporter,
+    max_queue_size=env_number("OTEL_BSP_MAX_QUEUE_SIZE", 1024),
+    schedule_delay_millis=env_number("OTEL_BSP_SCHEDULE_DELAY", 1000),
+    max_export_batch_size=env_number("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", 64),
+    export_timeout_millis=env_number("OTEL_BSP_EXPORT_TIMEOUT", 5000),
+)
+
 def create_tracer_provider(service_name):
-    """Create a separate tracer provider for each service"""
+    """Create a tracer provider for one service, exporting through the shared processor"""
     resource = Resource(attributes={
         "service.name": service_name
     })
-    
-    provider = TracerProvider(resource=resource)
-    
-    otlp_exporter = OTLPSpanExporter(
-        endpoint="http://127.0.0.1:4318/v1/traces"
-    )
-    
-    provider.add_span_processor(BatchSpanProcessor(otlp_exporter))
-    
+
+    provider = TracerProvider(resource=resource, sampler=sampler)
+    provider.add_span_processor(span_processor)
+
     return provider
 
 # Create separate tracer providers for each service
@@ -59,85 +230,175 @@ frontend_tracer = frontend_provider.get_tracer("frontend")
 backend_tracer = backend_provider.get_tracer("backend")
 database_tracer = database_provider.get_tracer("database")
 
+_get_current_span = trace.get_current_span
+
 def get_trace_id():
     """Helper to get the current trace ID for logging correlation"""
-    span = trace.get_current_span()
-    if span:
-        trace_id = span.get_span_context().trace_id
-        return format(trace_id, '032x')
-    return "unknown"
+    # get_current_span() never returns None; outside a span it returns
+    # INVALID_SPAN, whose context is not valid. Unsampled traces are never
+    # exported, so don't hand out an ID that would link to nothing in Tempo.
+    ctx = _get_current_span().get_span_context()
+    return format(ctx.trace_id, '032x') if ctx.is_valid and ctx.trace_flags.sampled else "unknown"
+
+# --- Simulated Latency ---
+# Sleep durations are drawn up front from a fixed seed and replayed in a loop,
+# so the hot path skips the RNG. The sequence is the same every run, but the
+# workers share it, so which request gets which sleep depends on thread
+# scheduling; only the overall latency distribution is reproducible.
+_SCHEDULE_SIZE = 10_000
+_schedule_rng = random.Random(0)
+
+def latency_schedule(low, high):
+    return itertools.cycle([_schedule_rng.uniform(low, high) for _ in range(_SCHEDULE_SIZE)])
+
+db_sleeps = latency_schedule(0.05, 0.15)
+backend_sleeps = latency_schedule(0.1, 0.3)
+request_gaps = latency_schedule(0.5, 1.5)
+
+# --- Failure Injection ---
+# Each service fails independently at its own rate, but only if everything
+# upstream succeeded: frontend (bad session), backend (cache), database.
+FRONTEND_ERROR_RATE = 0.03
+BACKEND_ERROR_RATE = 0.05
+DB_ERROR_RATE = 0.08
+
+# Outcomes of a request, indexed by where it fails
+FAIL_FRONTEND, FAIL_BACKEND, FAIL_DATABASE, SUCCESS = range(4)
+OUTCOME_NAMES = ("frontend_error", "backend_error", "database_error", "success")
+
+def failure_thresholds(*rates):
+    """Fold chained per-service error rates into cumulative thresholds on one draw."""
+    thresholds = []
+    cumulative, survival = 0.0, 1.0
+    for rate in rates:
+        cumulative += survival * rate
+        survival *= 1 - rate
+        thresholds.append(cumulative)
+    return thresholds
+
+FAILURE_THRESHOLDS = failure_thresholds(FRONTEND_ERROR_RATE, BACKEND_ERROR_RATE, DB_ERROR_RATE)
+# Seeded, but shared by all workers: the failure rates are stable across runs,
+# the exact request that fails is not.
+_outcome_rng = random.Random(1)
+
+def draw_outcome():
+    """One RNG draw per request decides which service (if any) fails."""
+    return bisect.bisect_right(FAILURE_THRESHOLDS, _outcome_rng.random())
 
 # --- Service Functions ---
-def database_operation():
+_INFO = logging.INFO
+
+def span_logger(service_name):
+    """Bind a service's logger to the current trace ID for the rest of the span."""
+    return logging.LoggerAdapter(loggers[service_name], {"tags": {"trace_id": get_trace_id()}})
+
+# Span statuses are immutable, so build them once and reuse them
+_OK = trace.Status(trace.StatusCode.OK)
+_DB_FAIL = trace.Status(trace.StatusCode.ERROR, "DB connection failed")
+_DOWNSTREAM_DB = trace.Status(trace.StatusCode.ERROR, "Downstream DB error")
+_INVALID_SESSION = trace.Status(trace.StatusCode.ERROR, "Invalid user session")
+_BACKEND_FAIL = trace.Status(trace.StatusCode.ERROR, "Backend error")
+
+def database_operation(outcome):
     """This function now returns True for success and False for failure."""
     with database_tracer.start_as_current_span("db_query") as db_span:
-        time.sleep(random.uniform(0.05, 0.15))
-        
-        # Simulate occasional DB errors (e.g., 8% chance)
-        if random.random() < 0.08:
-            db_span.set_status(trace.Status(trace.StatusCode.ERROR, "DB connection failed"))
-            loggers["database"].error("DB connection failed", extra={"tags": {"trace_id": get_trace_id()}})
+        database_log = span_logger("database")
+        time.sleep(next(db_sleeps))
+
+        # Simulate occasional DB errors (DB_ERROR_RATE of the requests that reach
+        # the database, as picked by draw_outcome)
+        if outcome == FAIL_DATABASE:
+            db_span.set_status(_DB_FAIL)
+            database_log.error("DB connection failed")
             return False # Indicate failure
-        loggers["database"].info("Query successful", extra={"tags": {"trace_id": get_trace_id()}})
+        if database_log.isEnabledFor(_INFO):
+            database_log.info("Query successful")
         return True # Indicate success
 
-def backend_process():
-    with backend_tracer.start_as_current_span("backend_processing", kind=trace.SpanKind.INTERNAL) as backend_span:
-        
-        # Independent backend error (e.g., 5% chance of a cache failure)
-        if random.random() < 0.05:
-            backend_span.set_status(trace.Status(trace.StatusCode.ERROR, "Cache service unavailable"))
-            loggers["backend"].error("Cache service unavailable", extra={"tags": {"trace_id": get_trace_id()}})
-            return False
+def backend_process(outcome):
+    # Independent backend error (BACKEND_ERROR_RATE chance of a cache failure).
+    # The request fails before any backend work, so skip the backend span and
+    # log under the caller's span; the frontend span records the error status.
+    if outcome == FAIL_BACKEND:
+        span_logger("backend").error("Cache service unavailable")
+        return False
 
-        time.sleep(random.uniform(0.1, 0.3))
+    with backend_tracer.start_as_current_span("backend_processing", kind=trace.SpanKind.INTERNAL) as backend_span:
+        backend_log = span_logger("backend")
+        time.sleep(next(backend_sleeps))
         
         # Call the database
-        db_success = database_operation()
+        db_success = database_operation(outcome)
         if not db_success:
-            backend_span.set_status(trace.Status(trace.StatusCode.ERROR, "Downstream DB error"))
-            loggers["backend"].error("Backend failed due to downstream DB error", extra={"tags": {"trace_id": get_trace_id()}})
+            backend_span.set_status(_DOWNSTREAM_DB)
+            backend_log.error("Backend failed due to downstream DB error")
             return False
         
-        loggers["backend"].info("Backend processing complete", extra={"tags": {"trace_id": get_trace_id()}})
+        if backend_log.isEnabledFor(_INFO):
+            backend_log.info("Backend processing complete")
         return True
 
 def frontend_request():
-    # This is the parent span for the entire request
-    with frontend_tracer.start_as_current_span("/api/users", kind=trace.SpanKind.SERVER) as parent_span:
-        trace_id = get_trace_id()
-        loggers["frontend"].info(f"Received request for /api/users", extra={"tags": {"trace_id": trace_id}})
+    outcome = draw_outcome()
+
+    # This is the parent span for the entire request. The outcome goes in as a
+    # start attribute so the sampler can keep every failing trace.
+    with frontend_tracer.start_as_current_span("/api/users", kind=trace.SpanKind.SERVER, attributes={OUTCOME_ATTRIBUTE: OUTCOME_NAMES[outcome]}) as parent_span:
+        frontend_log = span_logger("frontend")
+        if frontend_log.isEnabledFor(_INFO):
+            frontend_log.info("Received request for /api/users")
         
         # Independent frontend error (e.g., 3% chance of a bad request/auth issue)
-        if random.random() < 0.03:
-            parent_span.set_status(trace.Status(trace.StatusCode.ERROR, "Invalid user session"))
-            loggers["frontend"].error("Invalid user session token", extra={"tags": {"trace_id": trace_id}})
+        if outcome == FAIL_FRONTEND:
+            parent_span.set_status(_INVALID_SESSION)
+            frontend_log.error("Invalid user session token")
             return # End the request here
 
         # Call the backend service and handle its success/failure response
-        backend_success = backend_process()
+        backend_success = backend_process(outcome)
         if not backend_success:
-            parent_span.set_status(trace.Status(trace.StatusCode.ERROR, "Backend error"))
-            loggers["frontend"].error("Request to /api/users failed due to backend error", extra={"tags": {"trace_id": trace_id}})
+            parent_span.set_status(_BACKEND_FAIL)
+            frontend_log.error("Request to /api/users failed due to backend error")
             return
         
         # If we get here, everything succeeded
-        parent_span.set_status(trace.Status(trace.StatusCode.OK))
-        loggers["frontend"].info("Transaction successful", extra={"tags": {"trace_id": trace_id}})
+        parent_span.set_status(_OK)
+        if frontend_log.isEnabledFor(_INFO):
+            frontend_log.info("Transaction successful")
 
-def main_loop():
-    while True:
+# Number of concurrent request workers driving load through the app
+NUM_WORKERS = env_number("MOCK_APP_WORKERS", 16)
+stop_event = threading.Event()
+
+def worker_loop():
+    while not stop_event.is_set():
         try:
             frontend_request()
         except Exception as e:
             # This is a generic, unexpected error
             loggers["my-app"].error(f"An unexpected error occurred: {e}", extra={"tags": {"trace_id": "unknown"}})
-        
-        time.sleep(random.uniform(0.5, 1.5))
+
+        stop_event.wait(next(request_gaps))
+
+def main_loop():
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for _ in range(NUM_WORKERS):
+            pool.submit(worker_loop)
+        try:
+            while not stop_event.wait(1):
+                pass
+        finally:
+            # Let the workers finish their current request and exit
+            stop_event.set()
 
 if __name__ == "__main__":
-    print("Starting mock application with distributed tracing...")
+    # SIGTERM (e.g. `docker stop`) would otherwise kill the process without
+    # running atexit handlers, dropping the spans and logs still queued for
+    # export. Exiting normally lets the tracer provider and log listeners flush.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"Starting mock application with distributed tracing ({NUM_WORKERS} workers)...")
     print("Sending logs to Loki at http://127.0.0.1:3100")
-    print("Sending traces to Tempo at http://127.0.0.1:4318")
+    print("Sending traces to Tempo at 127.0.0.1:4317 (OTLP gRPC)")
     main_loop()
 